@@ -1,57 +1,77 @@
 #! /usr/bin/env python
-import operator
-from functools import reduce
+import heapq
+from itertools import combinations
 import numpy as np
 import pandas as pd
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the kernels then run as plain Python functions
+    def njit(*args, **kwargs):
+        return lambda function: function
+
 
 class Factor(object):
     """
-    A class representing a factor using a pandas DataFrame.
+    A class representing a factor using a dense numpy array.
 
     A factor defined on a set of discrete random variables is a function associating a value in R for each possible
     combination of values of the variables.
 
-    These values are stored in a column named 'phi'. The variables names are the level names of the row multiindex.
-    The variables values are 0, 1, ..., n where n is the cardinality of the variable.
+    The values are stored in a n-dimensional array with one axis per variable; the variables values are
+    0, 1, ..., n where n is the cardinality of the variable, and are implicit in the array strides.
 
     Attributes
     ----------
-    values : pandas.DataFrame
-        A dataframe containing the values of the factor; variables are in the lexicographic order of the names; rows are
-        ordered according to the variable values.
-        Eg :
-
-        +----+----+-----+
-        |    |    | phi |
-        +----+----+-----+
-        | v1 | v2 |     |
-        +====+====+=====+
-        |  0 |  0 | 0.1 |
-        +----+----+-----+
-        |  0 |  1 | 0.9 |
-        +----+----+-----+
-        |  1 |  0 | 0.7 |
-        +----+----+-----+
-        |  1 |  1 | 0.3 |
-        +----+----+-----+
+    values : numpy.ndarray
+        A C-contiguous array of float containing the values of the factor, of shape `variable_cardinalities`; axes are
+        in the lexicographic order of the variables names.
+        Eg : for variables ('v1', 'v2') of cardinalities (2, 2)
+
+        +--------+--------+--------+
+        |        | v2 = 0 | v2 = 1 |
+        +========+========+========+
+        | v1 = 0 |   0.1  |   0.9  |
+        +--------+--------+--------+
+        | v1 = 1 |   0.7  |   0.3  |
+        +--------+--------+--------+
+
+    log : bool
+        Whether `values` holds the logarithm of the factor values. Log-space factors are stored as float32 : products
+        become sums, which neither underflow on long chains nor need double precision.
 
     """
-    def __init__(self, df):
+    def __init__(self, values, variables, cardinalities, log=False):
         """
         Parameters
         ----------
-        df : pandas.DataFrame
-            A dataframe containing the values of the factor. The dataframe must respect the above-mentioned convention
-            (one column named 'phi', variables names are the multiindex level names, variables values are
-            range(0, variable_cardinality))
+        values : numpy.ndarray
+            An array of shape `cardinalities` containing the values of the factor; axis i corresponds to variables[i]
+        variables : sequence of str
+            The variables names, in any order
+        cardinalities : sequence of int
+            The cardinality of each variable, ordered as given in 'variables'
+        log : bool
+            Whether `values` holds the logarithm of the factor values
         """
-        assert df.columns == ['phi']
-        names = df.index.names
-        self.values = df.reset_index().set_index(sorted(names)).sort_index()
+        variables = tuple(variables)
+        cardinalities = tuple(cardinalities)
+        values = np.asarray(values, dtype=np.float32 if log else np.float64)
+        assert values.shape == cardinalities
+        if all(a < b for a, b in zip(variables, variables[1:])):
+            self._variables = variables
+            self._cardinalities = cardinalities
+        else:
+            perm = sorted(range(len(variables)), key=variables.__getitem__)
+            self._variables = tuple(variables[i] for i in perm)
+            self._cardinalities = tuple(cardinalities[i] for i in perm)
+            values = np.transpose(values, perm)
+        self.values = np.asarray(values, order='C')
+        assert self.values.flags['C_CONTIGUOUS']
+        self.log = log
 
     @classmethod
-    def from_scratch(cls, variables, variable_cardinalities, values=None):
+    def from_scratch(cls, variables, variable_cardinalities, values=None, log=False):
         """ Construct a factor from a list of variables with their associated cardinalities and a list of values.
         The factor values are ordered so that they correspond to the variables values in the tuple ordering.
 
@@ -64,42 +84,231 @@ class Factor(object):
         variable_cardinalities : list of int
             List of the cardinality of each variable, ordered as given in 'variables' list. Values of the variables are
              range(0, variables_cardinalities[i])
-        values : list of float
-            Values taken by the factor on each combination of variables values
+        values : list of float, optional
+            Values taken by the factor on each combination of variables values; defaults to ones
+        log : bool
+            Whether to store the factor in log-space; `values` are then the (non-log) values of the factor
 
         Returns
         -------
         Factor
 
         """
-        if not values:
-            values = np.ones(np.prod(np.array(variable_cardinalities)))
+        if values is None:
+            values = np.ones(variable_cardinalities)
         else:
-            assert len(values) == reduce(operator.mul, variable_cardinalities)
-        index = pd.MultiIndex.from_product([range(c) for c in variable_cardinalities], names=variables)
-        df = pd.DataFrame(data=values, index=index, columns=['phi'])
-        return cls(df)
+            values = np.asarray(values, dtype=np.float64).reshape(variable_cardinalities)
+        if log:
+            with np.errstate(divide='ignore'):
+                values = np.log(values)
+        return cls(values, variables, variable_cardinalities, log=log)
+
+    @classmethod
+    def from_dataframe(cls, df, log=False):
+        """ Construct a factor from a pandas DataFrame.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            A dataframe containing the values of the factor, with one column named 'phi'; variables names are the
+            index level names and the index levels are range(0, variable_cardinality). See `to_frame`. Values missing
+            from the dataframe are set to NaN. A single row with an unnamed index is read as a factor with an empty
+            scope.
+        log : bool
+            Whether 'phi' holds the logarithm of the factor values, as produced by `to_frame` for a log-space factor
+
+        Returns
+        -------
+        Factor
+
+        """
+        assert list(df.columns) == ['phi']
+        if list(df.index.names) == [None]:
+            assert len(df) == 1
+            return cls(df['phi'].values[0], (), (), log=log)
+        index = df.index if isinstance(df.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([df.index])
+        assert all(list(level) == list(range(len(level))) for level in index.levels)
+        cardinalities = index.levshape
+        # the levels are ranges, so the codes are the variables values ('labels' before pandas 0.24)
+        assignments = getattr(index, 'codes', None) or index.labels
+        if index.is_monotonic_increasing and index.is_unique and len(index) == np.prod(cardinalities):
+            # rows already enumerate every assignment in row-major order
+            values = np.array(df['phi'].values, dtype=np.float64).reshape(cardinalities)
+        else:
+            values = np.full(cardinalities, np.nan)
+            values.ravel()[np.ravel_multi_index(assignments, cardinalities)] = df['phi'].values
+        return cls(values, index.names, cardinalities, log=log)
+
+    def to_frame(self):
+        """ Return the factor as a pandas DataFrame
+
+        Returns
+        -------
+        pandas.DataFrame
+            A dataframe with one column named 'phi'; variables names are the multiindex level names, in lexicographic
+            order, and rows are ordered according to the variables values. For a factor in log-space, 'phi' holds the
+            logarithm of the values. A factor with an empty scope gives a single row with an unnamed index.
+            Eg :
+
+            +----+----+-----+
+            |    |    | phi |
+            +----+----+-----+
+            | v1 | v2 |     |
+            +====+====+=====+
+            |  0 |  0 | 0.1 |
+            +----+----+-----+
+            |  0 |  1 | 0.9 |
+            +----+----+-----+
+            |  1 |  0 | 0.7 |
+            +----+----+-----+
+            |  1 |  1 | 0.3 |
+            +----+----+-----+
+
+        """
+        if not self._variables:
+            return pd.DataFrame(data=self.values.reshape(1), columns=['phi'])
+        index = pd.MultiIndex.from_product([range(c) for c in self._cardinalities], names=list(self._variables))
+        return pd.DataFrame(data=self.values.ravel(), index=index, columns=['phi'])
+
+    def to_log(self):
+        """ Return the factor in log-space
+
+        Returns
+        -------
+        Factor
+
+        """
+        if self.log:
+            return self
+        with np.errstate(divide='ignore'):
+            return Factor(np.log(self.values), self._variables, self._cardinalities, log=True)
+
+    def to_linear(self):
+        """ Return the factor out of log-space
+
+        Returns
+        -------
+        Factor
+
+        """
+        if not self.log:
+            return self
+        return Factor(np.exp(self.values.astype(np.float64)), self._variables, self._cardinalities)
+
+    def normalize(self):
+        """ Return the factor normalized so that its values sum to 1
+
+        Returns
+        -------
+        Factor
+
+        """
+        if self.log:
+            values = self.values - _logsumexp(self.values, tuple(range(self.values.ndim)))
+        else:
+            values = self.values / self.values.sum()
+        return Factor(values, self._variables, self._cardinalities, log=self.log)
 
     @property
     def variables(self):
-        """ list of str : list of the variables names"""
-        return self.values.index.names
+        """ tuple of str : the variables names, in lexicographic order """
+        return self._variables
 
     @property
     def variable_cardinalities(self):
-        """ list of int : list of the variables cardinalities """
-        return list(map(len, self.values.index.levels))
+        """ tuple of int : the variables cardinalities, ordered as `variables` """
+        return self._cardinalities
 
     def __mul__(self, other):
         return factor_product(self, other)
 
     def __eq__(self, other):
-        return self.values.equals(other.values)
+        if not isinstance(other, Factor):
+            return NotImplemented
+        return (self.log == other.log and self._variables == other._variables
+                and self._cardinalities == other._cardinalities and np.array_equal(self.values, other.values))
+
+    def __str__(self):
+        return str(self.to_frame())
+
+
+def _merge_scopes(factor1, factor2):
+    """ Merge the scopes of two factors in a single pass over their sorted variables
+
+    Returns
+    -------
+    tuple
+        The union of the variables, in lexicographic order, then as int64 arrays ordered as this union : their
+        cardinalities and the strides, in number of elements, of the flattened values of each factor along them (0 for a
+        variable which is not in the scope of the factor)
+    """
+    variables1, cardinalities1 = factor1._variables, factor1._cardinalities
+    variables2, cardinalities2 = factor2._variables, factor2._cardinalities
+    strides1 = [s // factor1.values.itemsize for s in factor1.values.strides]
+    strides2 = [s // factor2.values.itemsize for s in factor2.values.strides]
+    n1, n2 = len(variables1), len(variables2)
+    variables, card, stride1, stride2 = [], [], [], []
+    i = j = 0
+    while i < n1 or j < n2:
+        if j == n2 or (i < n1 and variables1[i] < variables2[j]):
+            variables.append(variables1[i])
+            card.append(cardinalities1[i])
+            stride1.append(strides1[i])
+            stride2.append(0)
+            i += 1
+        elif i == n1 or variables2[j] < variables1[i]:
+            variables.append(variables2[j])
+            card.append(cardinalities2[j])
+            stride1.append(0)
+            stride2.append(strides2[j])
+            j += 1
+        else:
+            assert cardinalities1[i] == cardinalities2[j]
+            variables.append(variables1[i])
+            card.append(cardinalities1[i])
+            stride1.append(strides1[i])
+            stride2.append(strides2[j])
+            i += 1
+            j += 1
+    return (tuple(variables), np.array(card, dtype=np.int64),
+            np.array(stride1, dtype=np.int64), np.array(stride2, dtype=np.int64))
+
+
+@njit(cache=True)
+def _product_kernel(out, a1, a2, stride1, stride2, card, log):
+    """ Fill `out` with the product of the flattened factors values `a1` and `a2`, or with their sum if `log` is set
+
+    This is Algorithm 10.A.1 from Koller & Friedman, Probabilistic Graphical Models : the assignment of the output
+    factor is walked in row-major order, and the corresponding positions `j` and `k` in the input factors are updated
+    incrementally using their strides along each variable. It is compiled with numba when available.
+    """
+    n = card.shape[0]
+    assignment = np.zeros(n, dtype=np.int64)
+    j = 0
+    k = 0
+    for i in range(out.shape[0]):
+        if log:
+            out[i] = a1[j] + a2[k]
+        else:
+            out[i] = a1[j] * a2[k]
+        for l in range(n - 1, -1, -1):
+            assignment[l] += 1
+            if assignment[l] == card[l]:
+                assignment[l] = 0
+                j -= (card[l] - 1) * stride1[l]
+                k -= (card[l] - 1) * stride2[l]
+            else:
+                j += stride1[l]
+                k += stride2[l]
+                break
 
 
 def factor_product(factor1, factor2):
     """ Compute the product of two factors
 
+    If any of the factors is in log-space, so is the product. Factors with identical or disjoint scopes are combined
+    with a single elementwise or outer numpy operation; otherwise, the general index walk is used.
+
     Parameters
     ----------
     factor1, factor2 : Factor
@@ -110,16 +319,30 @@ def factor_product(factor1, factor2):
         The resulting product
 
     """
-    new_variables = set(factor1.variables).union(set(factor2.variables))
-    joined_variables = set.intersection(set(factor1.variables), set(factor2.variables))
-    tmp1 = factor1.values.reset_index()
-    tmp2 = factor2.values.reset_index()
-    tmp = pd.merge(tmp1, tmp2, on=sorted(joined_variables))
-    tmp['phi'] = np.multiply(tmp['phi_x'], tmp['phi_y'])
-    del tmp['phi_x']
-    del tmp['phi_y']
-    tmp = tmp.set_index(sorted(new_variables)).sort_index()
-    return Factor(tmp)
+    log = factor1.log or factor2.log
+    if log:
+        factor1, factor2 = factor1.to_log(), factor2.to_log()
+    variables1, variables2 = factor1._variables, factor2._variables
+    combine = np.add if log else np.multiply
+    if variables1 == variables2:
+        assert factor1._cardinalities == factor2._cardinalities
+        return Factor(combine(factor1.values, factor2.values), variables1, factor1._cardinalities, log=log)
+    variables, card, stride1, stride2 = _merge_scopes(factor1, factor2)
+    if len(variables) == len(variables1) + len(variables2):
+        return Factor(combine.outer(factor1.values, factor2.values), variables1 + variables2,
+                      factor1._cardinalities + factor2._cardinalities, log=log)
+    out = np.empty(int(np.prod(card)), dtype=factor1.values.dtype)
+    _product_kernel(out, factor1.values.ravel(), factor2.values.ravel(), stride1, stride2, card, log)
+    return Factor(out.reshape(card), variables, tuple(card.tolist()), log=log)
+
+
+def _logsumexp(values, axis):
+    """ Compute log(sum(exp(values))) over the given axes, in double precision and without overflow """
+    values = values.astype(np.float64)
+    shift = values.max(axis=axis, keepdims=True)
+    shift = np.where(np.isfinite(shift), shift, 0.)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(values - shift).sum(axis=axis)) + np.squeeze(shift, axis=axis)
 
 
 def factor_marginalization(factor, variables):
@@ -138,18 +361,18 @@ def factor_marginalization(factor, variables):
         A new factor in which given variables have been marginalised
 
     """
-    kept_variables = list(set(factor.variables) - set(variables))
-    tmp = factor.values.reset_index()
-    df = tmp.groupby(by=kept_variables).aggregate(sum)
-    for v in variables:
-        del df[v]
-    return Factor(df)
+    factor_variables = factor._variables
+    axes = tuple(factor_variables.index(v) for v in variables)
+    kept = [(v, c) for v, c in zip(factor_variables, factor._cardinalities) if v not in variables]
+    values = _logsumexp(factor.values, axes) if factor.log else factor.values.sum(axis=axes)
+    return Factor(values, [v for v, _ in kept], [c for _, c in kept], log=factor.log)
 
 
 def observe_evidence(factor, evidence):
     """ Modify the values in a factor to reflect observed evidence
 
-    The values which are incompatible with the observed evidence are set to 0. The returned factor is NOT normalized.
+    The values which are incompatible with the observed evidence are set to 0 (-inf in log-space). The returned factor
+    is NOT normalized.
 
     Parameters
     ----------
@@ -161,13 +384,37 @@ def observe_evidence(factor, evidence):
     Returns
     -------
     Factor
-        A copy of the input factor in which appropriate values are modified to reflect evidence
+        A copy of the input factor in which appropriate values are modified to reflect evidence, or the input factor
+        itself if none of the observed variables is in its scope
+
+    Raises
+    ------
+    ValueError
+        If an observed value is out of the range of its variable
     """
-    tmp = factor.values.reset_index()
-    for variable, value in evidence.items():
-        if variable in tmp.columns:
-            tmp.loc[tmp[variable] != value, 'phi'] = 0.
-    return Factor(tmp.set_index(factor.variables))
+    variables = factor._variables
+    relevant = [(variable, value) for variable, value in evidence.items() if variable in variables]
+    if not relevant:
+        return factor
+    values = factor.values.copy()
+    for variable, value in relevant:
+        axis = variables.index(variable)
+        if not 0 <= value < values.shape[axis]:
+            raise ValueError('Observed value {} is out of range for variable {}'.format(value, variable))
+        incompatible = [slice(None)] * values.ndim
+        incompatible[axis] = np.arange(values.shape[axis]) != value
+        values[tuple(incompatible)] = -np.inf if factor.log else 0.
+    return Factor(values, variables, factor._cardinalities, log=factor.log)
+
+
+def _product_size(factor1, scope1, scope2):
+    """ Number of values of the product of two factors, given the first one and the scopes of both as dicts of
+    variables / cardinalities """
+    size = factor1.values.size
+    for variable, cardinality in scope2.items():
+        if variable not in scope1:
+            size *= cardinality
+    return size
 
 
 def compute_joint_distribution(factors):
@@ -176,6 +423,10 @@ def compute_joint_distribution(factors):
     This correspond to a joint distribution represented by a Bayesian network such as :
         factors[0] -> factors[1] -> factors[2]
 
+    The factors are multiplied pairwise, always picking the pair whose product has the smallest number of values, in
+    order to keep the intermediate factors as small as possible. The sizes of the candidate pairs are kept in a heap,
+    so that each product only requires scoring the pairs it belongs to.
+
     Parameters
     ----------
     factors : list
@@ -187,6 +438,23 @@ def compute_joint_distribution(factors):
         The resulting joint distribution for the chain
 
     """
-    if len(factors) == 1:
-        return factors[0]
-    return factors[0] * compute_joint_distribution(factors[1:])
+    factors = dict(enumerate(factors))
+    scopes = {k: dict(zip(f._variables, f._cardinalities)) for k, f in factors.items()}
+    heap = [(_product_size(factors[i], scopes[i], scopes[j]), i, j) for i, j in combinations(factors, 2)]
+    heapq.heapify(heap)
+    key = len(factors)
+    while len(factors) > 1:
+        _, i, j = heapq.heappop(heap)
+        if i not in factors or j not in factors:
+            # one of the factors has already been multiplied
+            continue
+        product = factors.pop(i) * factors.pop(j)
+        del scopes[i], scopes[j]
+        scope = dict(zip(product._variables, product._cardinalities))
+        for k in factors:
+            heapq.heappush(heap, (_product_size(product, scope, scopes[k]), k, key))
+        factors[key] = product
+        scopes[key] = scope
+        key += 1
+    factor, = factors.values()
+    return factor
@@ -1,5 +1,7 @@
 from pgm.core import Factor, factor_marginalization, factor_product, observe_evidence, compute_joint_distribution
-from pandas.util.testing import assert_frame_equal
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal
 
 factor1 = Factor.from_scratch(variables=['v1'], variable_cardinalities=[2], values=[.11, .89])
 factor2 = Factor.from_scratch(variables=['v1', 'v2'], variable_cardinalities=[2, 2], values=[.59, .41, .22, .78])
@@ -11,32 +13,102 @@ marginal = Factor.from_scratch(variables=['v2', 'v3'], variable_cardinalities=[2
 def test_variable_ordering_independence():
     factor2bis = Factor.from_scratch(variables=['v2', 'v1'], variable_cardinalities=[2, 2], values=[.59, .22, .41, .78])
     assert factor2 == factor2bis
+    assert factor2 != factor3
+
+
+def test_dataframe_round_trip():
+    assert Factor.from_dataframe(factor2.to_frame()) == factor2
+    assert Factor.from_dataframe(factor1.to_frame()) == factor1
+    scalar = factor_marginalization(factor2, factor2.variables)
+    assert Factor.from_dataframe(scalar.to_frame()) == scalar
+    assert str(scalar) == str(scalar.to_frame())
+    log_factor = factor2.to_log()
+    assert Factor.from_dataframe(log_factor.to_frame(), log=True) == log_factor
+    partial = Factor.from_dataframe(factor2.to_frame().iloc[:3])
+    assert partial.variable_cardinalities == (2, 2)
+    np.testing.assert_array_equal(partial.values, [[.59, .41], [.22, np.nan]])
+
+
+def test_values_are_c_contiguous():
+    fortran = Factor(np.asfortranarray(factor3.values), factor3.variables, factor3.variable_cardinalities)
+    assert fortran == factor3
+    factors = [fortran, factor_product(factor1, fortran), factor_product(factor2, fortran),
+               factor_marginalization(factor2, ['v1']), observe_evidence(fortran, {'v2': 0}),
+               Factor.from_dataframe(factor2.to_frame().iloc[::-1]), factor2.to_log()]
+    for factor in factors:
+        assert factor.values.flags['C_CONTIGUOUS']
+
+
+def test_normalize():
+    np.testing.assert_allclose(factor2.normalize().values, factor2.values / 2.)
+    np.testing.assert_allclose(factor2.to_log().normalize().to_linear().values, factor2.values / 2., rtol=1e-6)
+    scalar = factor_marginalization(factor2, factor2.variables)
+    np.testing.assert_allclose(scalar.normalize().values, 1.)
+    np.testing.assert_allclose(scalar.to_log().normalize().to_linear().values, 1., rtol=1e-6)
 
 
 def test_factor_product():
     factor = Factor.from_scratch(variables=['v1', 'v2'], variable_cardinalities=[2, 2],
                                  values=[.0649, .0451, .1958, .6942])
 
-    assert_frame_equal(factor_product(factor1, factor2).values, factor.values)
+    assert_frame_equal(factor_product(factor1, factor2).to_frame(), factor.to_frame())
+
+
+def test_factor_product_identical_and_disjoint_scopes():
+    np.testing.assert_allclose(factor_product(factor2, factor2).values, factor2.values ** 2)
+    np.testing.assert_allclose(factor_product(factor1, factor3).values,
+                               np.einsum('i,jk->ijk', factor1.values, factor3.values))
 
 
 def test_factor_marginalisation():
     factor = Factor.from_scratch(variables=['v1'], variable_cardinalities=[2], values=[1., 1.])
-    assert_frame_equal(factor_marginalization(factor2, ['v2']).values, factor.values)
+    assert_frame_equal(factor_marginalization(factor2, ['v2']).to_frame(), factor.to_frame())
 
 
 def test_observe_evidence():
     evidences = {'v2': 0, 'v3': 1}
-    assert_frame_equal(factor1.values, observe_evidence(factor1, evidences).values)
+    assert_frame_equal(factor1.to_frame(), observe_evidence(factor1, evidences).to_frame())
+    assert observe_evidence(factor1, evidences) is factor1
     factor2bis = Factor.from_scratch(variables=['v1', 'v2'], variable_cardinalities=[2, 2], values=[.59, 0, .22, 0])
-    assert_frame_equal(factor2bis.values, observe_evidence(factor2, evidences).values)
-    assert factor2.values.iloc[1]['phi'] != 0
+    assert_frame_equal(factor2bis.to_frame(), observe_evidence(factor2, evidences).to_frame())
+    assert factor2.values[0, 1] != 0
     factor3bis = Factor.from_scratch(variables=['v2', 'v3'], variable_cardinalities=[2, 2], values=[0, .61, 0, 0])
-    assert_frame_equal(factor3bis.values, observe_evidence(factor3, evidences).values)
+    assert_frame_equal(factor3bis.to_frame(), observe_evidence(factor3, evidences).to_frame())
+    infinite = Factor.from_scratch(variables=['v1'], variable_cardinalities=[2], values=[np.inf, np.nan])
+    np.testing.assert_array_equal(observe_evidence(infinite, {'v1': 1}).values, [0., np.nan])
+    with pytest.raises(ValueError):
+        observe_evidence(factor1, {'v1': -1})
 
 
 def test_compute_joint_distribution():
     joint_factor = Factor.from_scratch(variables=['v1', 'v2', 'v3'],
                                        variable_cardinalities=[2, 2, 2],
                                        values=[.025311, .039589, .002706, .042394, .076362, .119438, .041652, .652548])
-    assert_frame_equal(joint_factor.values, compute_joint_distribution([factor1, factor2, factor3]).values)
+    assert_frame_equal(joint_factor.to_frame(), compute_joint_distribution([factor1, factor2, factor3]).to_frame())
+
+
+def test_compute_joint_distribution_ordering():
+    assert_frame_equal(compute_joint_distribution([factor1, factor2, factor3]).to_frame(),
+                       compute_joint_distribution([factor3, factor1, factor2]).to_frame())
+
+
+def test_log_space():
+    evidences = {'v2': 0, 'v3': 1}
+    log_joint = compute_joint_distribution([factor1.to_log(), factor2, factor3.to_log()])
+    joint = compute_joint_distribution([factor1, factor2, factor3])
+    assert log_joint.log and log_joint.values.dtype == np.float32
+    np.testing.assert_allclose(log_joint.to_linear().values, joint.values, rtol=1e-6)
+    np.testing.assert_allclose(factor_marginalization(log_joint, ['v1']).to_linear().values,
+                               factor_marginalization(joint, ['v1']).values, rtol=1e-6)
+    np.testing.assert_allclose(observe_evidence(log_joint, evidences).to_linear().values,
+                               observe_evidence(joint, evidences).values, rtol=1e-6)
+    log_scalar = factor_marginalization(log_joint, log_joint.variables)
+    assert log_scalar.values.shape == ()
+    np.testing.assert_allclose(factor_marginalization(log_scalar, []).to_linear().values, 1., rtol=1e-6)
+    np.testing.assert_allclose(log_scalar.normalize().to_linear().values, 1., rtol=1e-6)
+
+
+def test_compute_joint_distribution_long_chain():
+    factors = [factor1, factor2, factor3] * 40
+    np.testing.assert_allclose(compute_joint_distribution(factors).values,
+                               np.prod([compute_joint_distribution([factor1, factor2, factor3]).values] * 40, axis=0))